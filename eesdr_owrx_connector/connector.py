@@ -1,95 +1,128 @@
 import argparse
 import asyncio
+import collections
 import importlib.metadata
+import logging
 import signal
+import socket
 import sys
 
 from eesdr_tci import tci
 from eesdr_tci.listener import Listener
 from eesdr_tci.tci import TciCommandSendAction, TciStreamType
 
+log = logging.getLogger(__name__)
+
 def eprint(*args, **kwargs):
     print(*args, **kwargs, file=sys.stderr, flush=True)
 
 class SocketServer:
-    def __init__(self, kind, port, handler, verbose):
+    def __init__(self, kind, port, handler):
         self.kind = kind
         self.port = port
         self.handler = handler
-        self.verbose = verbose
 
     async def serve(self):
         print(f'Starting {self.kind} server on {self.port}', flush=True)
         server = await asyncio.start_server(self.handler, None, self.port)
-        if self.verbose:
+        if log.isEnabledFor(logging.DEBUG):
             addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
-            print(f'{self.kind} ready on {addrs}', flush=True)
+            log.debug('%s ready on %s', self.kind, addrs)
         await server.serve_forever()
 
     def start(self):
         return asyncio.create_task(self.serve())
 
 class ControlServer(SocketServer):
-    def __init__(self, port, verbose, keystore, ks_handlers):
+    def __init__(self, port, keystore, ks_handlers):
         self.keystore = keystore
-        self.ks_handlers = ks_handlers
-        SocketServer.__init__(self, 'Control', port, self.handle_control, verbose)
+        self.ks_dispatch = {k.encode('utf-8'): (k, h) for k, h in ks_handlers.items()}
+        SocketServer.__init__(self, 'Control', port, self.handle_control)
 
     async def handle_control(self, reader, writer):
         peer = writer.get_extra_info('peername')
         print(f'New control connection from {peer}', flush=True)
         try:
             while True:
-                data = await reader.readuntil(b'\n')
-                msg = data.decode('utf-8').strip()
-                if self.verbose:
-                    print(f'Control message received {msg}', flush=True)
-                if ':' not in msg:
+                line = (await reader.readuntil(b'\n')).strip()
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug('Control message received %s', line.decode('utf-8', 'replace'))
+                kb, sep, v = line.partition(b':')
+                if not sep:
                     continue
-                k, v = msg.split(':', 2)
-                if k not in self.keystore:
+                entry = self.ks_dispatch.get(kb)
+                if entry is None:
                     continue
+                k, handler = entry
                 try:
                     iv = int(v)
-                    if k == 'samp_rate' and iv not in Connector.SAMPLERATES:
-                        eprint('Invalid sample rate received on control channel. Ignored!')
-                        continue
-                    self.keystore[k] = iv
-                    if self.verbose:
-                        print('New values', self.keystore, flush=True)
-                    self.ks_handlers[k]()
                 except ValueError:
                     continue
+                if k == 'samp_rate' and iv not in Connector.SAMPLERATES:
+                    eprint('Invalid sample rate received on control channel. Ignored!')
+                    continue
+                self.keystore[k] = iv
+                log.debug('New values %s', self.keystore)
+                handler()
         except Exception as e:
             print('Error in control connection:', e, flush=True)
 
 class IqServer(SocketServer):
-    def __init__(self, port, verbose, demand_iq, iq_packets):
+    BACKLOG = 64
+    JOIN_LIMIT = 65536
+
+    def __init__(self, port, demand_iq, stop_iq, iq_clients):
         self.demand_iq = demand_iq
-        self.iq_packets = iq_packets
-        self.active_clients = 0
-        SocketServer.__init__(self, 'IQ', port, self.handle_iq, verbose)
+        self.stop_iq = stop_iq
+        self.iq_clients = iq_clients
+        SocketServer.__init__(self, 'IQ', port, self.handle_iq)
 
     async def handle_iq(self, _reader, writer):
         peer = writer.get_extra_info('peername')
         print(f'New IQ connection from {peer}', flush=True)
-        self.active_clients += 1
+        try:
+            writer.transport.set_write_buffer_limits(high=0)
+            sock = writer.get_extra_info('socket')
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            print('Error in IQ connection:', e, flush=True)
+            writer.close()
+            return
+        iq_packets = collections.deque(maxlen=IqServer.BACKLOG)
+        iq_ready = asyncio.Event()
+        client = (iq_packets.append, iq_ready.set)
+        self.iq_clients.append(client)
         self.demand_iq.set()
         try:
             while True:
-                data = await self.iq_packets.get()
-                writer.write(data)
+                await iq_ready.wait()
+                iq_ready.clear()
+                chunks = []
+                size = 0
+                while iq_packets:
+                    chunk = iq_packets.popleft()
+                    chunks.append(chunk)
+                    size += len(chunk)
+                if not chunks:
+                    continue
+                if size < IqServer.JOIN_LIMIT:
+                    writer.write(b''.join(chunks))
+                else:
+                    writer.writelines(chunks)
                 await writer.drain()
-                self.iq_packets.task_done()
         except Exception as e:
             print('Error in IQ connection:', e, flush=True)
         finally:
-            self.active_clients -= 1
-            if self.active_clients == 0:
+            self.iq_clients.remove(client)
+            if not self.iq_clients:
                 self.demand_iq.clear()
+                self.stop_iq.set()
 
 class Connector:
     SAMPLERATES = [48000, 96000, 192000, 384000]
+    RATE_COMMAND = tci.COMMANDS['IQ_SAMPLERATE']
+    CENTER_COMMAND = tci.COMMANDS['DDS']
 
     def __init__(self):
         self.args = None
@@ -99,21 +132,28 @@ class Connector:
         self.tci_ready = None
         self.tasks = []
         self.demand_iq = None
-        self.iq_packets = None
+        self.stop_iq = None
+        self.iq_clients = []
         self.shutdown = False
 
-    def update_rate(self):
-        self.tci_listener.send_nowait(tci.COMMANDS['IQ_SAMPLERATE'].prepare_string(
+    def rate_command(self):
+        return Connector.RATE_COMMAND.prepare_string(
             TciCommandSendAction.WRITE,
             params=[self.keystore['samp_rate']]
-        ))
+        )
 
-    def update_center(self):
-        self.tci_listener.send_nowait(tci.COMMANDS['DDS'].prepare_string(
+    def center_command(self):
+        return Connector.CENTER_COMMAND.prepare_string(
             TciCommandSendAction.WRITE,
             rx=self.args.receiver,
             params=[self.keystore['center_freq']]
-        ))
+        )
+
+    def update_rate(self):
+        self.tci_listener.send_nowait(self.rate_command())
+
+    def update_center(self):
+        self.tci_listener.send_nowait(self.center_command())
 
     async def tci_check_response(self, command, rx, subrx, param):
         del subrx
@@ -122,9 +162,6 @@ class Connector:
         if command == 'DDS' and rx == self.args.receiver and param != self.keystore['center_freq']:
             eprint('DDS received that does not match desired center frequency')
 
-    async def tci_receive_data(self, packet):
-        self.iq_packets.put_nowait(packet.data)
-
     async def tci_interface(self):
         print(f'Opening TCI connection to {self.args.device}', flush=True)
         self.tci_listener = Listener(f'ws://{self.args.device}')
@@ -137,8 +174,42 @@ class Connector:
 
         self.demand_iq = asyncio.Event()
         self.demand_iq.clear()
-        self.iq_packets = asyncio.Queue()
-        self.tci_listener.add_data_listener(TciStreamType.IQ_STREAM, self.tci_receive_data)
+        self.stop_iq = asyncio.Event()
+
+        iq_clients = self.iq_clients
+        async def _receive_data(packet):
+            data = packet.data
+            if data is None:
+                return
+            for iq_append, iq_notify in iq_clients:
+                iq_append(data)
+                iq_notify()
+
+        self.tci_listener.add_data_listener(TciStreamType.IQ_STREAM, _receive_data)
+
+        # Only the rate and center change between streams, so format everything else once
+        start_frames = []
+        stop_frames = [tci.COMMANDS['IQ_STOP'].prepare_string(
+            TciCommandSendAction.WRITE,
+            rx=self.args.receiver
+        )]
+        if self.args.startstop:
+            start_frames.append(tci.COMMANDS['START'].prepare_string(
+                TciCommandSendAction.WRITE
+            ))
+            stop_frames.append(tci.COMMANDS['STOP'].prepare_string(
+                TciCommandSendAction.WRITE
+            ))
+        start_frames.append(tci.COMMANDS['RX_ENABLE'].prepare_string(
+            TciCommandSendAction.WRITE,
+            rx=self.args.receiver,
+            params=[True]
+        ))
+        iq_start_frame = tci.COMMANDS['IQ_START'].prepare_string(
+            TciCommandSendAction.WRITE,
+            rx=self.args.receiver
+        )
+
         self.tci_ready.set()
 
         while not self.shutdown:
@@ -152,54 +223,29 @@ class Connector:
             except asyncio.exceptions.CancelledError:
                 return
 
-            if self.args.verbose:
-                print('IQ demand start', flush=True)
-            if self.args.startstop:
-                self.tci_listener.send_nowait(tci.COMMANDS['START'].prepare_string(
-                    TciCommandSendAction.WRITE
-                ))
-            self.tci_listener.send_nowait(tci.COMMANDS['RX_ENABLE'].prepare_string(
-                TciCommandSendAction.WRITE,
-                rx=self.args.receiver,
-                params=[True]
-            ))
-            self.update_rate()
-            self.update_center()
-            self.tci_listener.send_nowait(tci.COMMANDS['IQ_START'].prepare_string(
-                TciCommandSendAction.WRITE,
-                rx=self.args.receiver
-            ))
-            while self.demand_iq.is_set():
-                try:
-                    await asyncio.sleep(0.05)
-                    if self.tci_listener._launch_task.done():
-                        print(f'TCI client closed prematurely: {self.tci_listener._launch_task.exception()}', flush=True)
-                        return
-                except asyncio.exceptions.CancelledError:
-                    break
-            if self.args.verbose:
-                print('IQ demand stop', flush=True)
-            self.tci_listener.send_nowait(tci.COMMANDS['IQ_STOP'].prepare_string(
-                TciCommandSendAction.WRITE,
-                rx=self.args.receiver
-            ))
-            if self.args.startstop:
-                self.tci_listener.send_nowait(tci.COMMANDS['STOP'].prepare_string(
-                    TciCommandSendAction.WRITE
-                ))
-            while self.iq_packets.qsize():
-                self.iq_packets.get_nowait()
-                self.iq_packets.task_done()
-
-    def cleanup(self, *_):
-        async def _cleanup():
-            if self.args.verbose:
-                print('Received signal, shutting down', flush=True)
-            self.shutdown = True
-            for task in self.tasks:
-                task.cancel()
-
-        asyncio.get_running_loop().create_task(_cleanup())
+            log.debug('IQ demand start')
+            frames = start_frames + [self.rate_command(), self.center_command(), iq_start_frame]
+            for frame in frames:
+                self.tci_listener.send_nowait(frame)
+            stop_task = asyncio.create_task(self.stop_iq.wait())
+            try:
+                done, _ = await asyncio.wait([stop_task, self.tci_listener._launch_task],
+                    return_when=asyncio.FIRST_COMPLETED)
+                if self.tci_listener._launch_task in done:
+                    print(f'TCI client closed prematurely: {self.tci_listener._launch_task.exception()}', flush=True)
+                    return
+            except asyncio.exceptions.CancelledError:
+                stop_task.cancel()
+            self.stop_iq.clear()
+            log.debug('IQ demand stop')
+            for frame in stop_frames:
+                self.tci_listener.send_nowait(frame)
+
+    def cleanup(self):
+        log.debug('Received signal, shutting down')
+        self.shutdown = True
+        for task in self.tasks:
+            task.cancel()
 
     async def start(self):
         parser = argparse.ArgumentParser(
@@ -252,11 +298,17 @@ class Connector:
         print('eesdr-tci            version', importlib.metadata.version('eesdr-tci'))
 
         self.args = parser.parse_args()
+        log.setLevel(logging.DEBUG if self.args.verbose else logging.INFO)
         self.keystore['center_freq'] = self.args.frequency
         self.keystore['samp_rate'] = self.args.samplerate
 
-        signal.signal(signal.SIGTERM, self.cleanup)
-        signal.signal(signal.SIGINT,  self.cleanup)
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.cleanup)
+            except NotImplementedError:
+                # Windows event loops have no add_signal_handler
+                signal.signal(sig, lambda *_: loop.call_soon_threadsafe(self.cleanup))
 
         self.tci_ready = asyncio.Event()
         ready_task = asyncio.create_task(self.tci_ready.wait())
@@ -266,19 +318,38 @@ class Connector:
             print(f'Error during TCI client start: {tci_task.exception()}', flush=True)
             return
         self.tasks += [tci_task]
-        self.tasks += [ControlServer(self.args.control, self.args.verbose, self.keystore, self.ks_handlers).start()]
-        self.tasks += [IqServer(self.args.port, self.args.verbose, self.demand_iq, self.iq_packets).start()]
+        self.tasks += [ControlServer(self.args.control, self.keystore, self.ks_handlers).start()]
+        self.tasks += [IqServer(self.args.port, self.demand_iq, self.stop_iq,
+            self.iq_clients).start()]
 
         await asyncio.wait(self.tasks, return_when=asyncio.FIRST_COMPLETED)
         self.cleanup()
-        await asyncio.wait(self.tasks)
+        results = await asyncio.gather(*self.tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                eprint('Task ended with error:', repr(result))
 
-        if self.args.verbose:
-            print('All tasks complete', flush=True)
+        log.debug('All tasks complete')
 
 def main():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(handler)
+    log.propagate = False
     c = Connector()
-    asyncio.run(c.start())
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+
+    if uvloop is None:
+        asyncio.run(c.start())
+    elif sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            runner.run(c.start())
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.run(c.start())
 
 if __name__ == '__main__':
     main()